@@ -6,17 +6,112 @@ Created on Tue Jun  9 18:17:45 2020
 @author: vonikakv
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import cv2
 import imageio
-import matplotlib.pyplot as plt
-from skimage.filters import (gaussian, threshold_otsu, threshold_niblack, 
+import numpy as np
+from numba import njit, prange
+from skimage.filters import (threshold_otsu, threshold_niblack,
                              threshold_sauvola)
 from skimage.color import rgb2gray
 from skimage import img_as_float
-from skimage.morphology import remove_small_objects
+
+try:
+    import cupy
+    from cupyx.scipy import ndimage as cupy_ndimage
+except ImportError:
+    cupy = None  # the GPU backend is optional
+
+
+
+if cupy is not None:
+    # fused elementwise OFF center-surround response on the GPU: a single
+    # kernel launch with one device-memory read per input and one write,
+    # mirroring _off_cs_kernel below
+    _off_cs_kernel_gpu = cupy.ElementwiseKernel(
+        'float32 c, float32 s',
+        'float32 o',
+        '''
+        float d = s - c;
+        if (d < 0.0f) d = 0.0f;
+        float v = ((1.0f + s) * d) / (s + d + 1e-12f);
+        if (v < 0.0f) v = 0.0f;
+        if (v > 1.0f) v = 1.0f;
+        o = 1.0f - v;
+        ''',
+        'off_cs'
+        )
 
 
 
-plt.close('all')
+@lru_cache(maxsize=32)
+def _gaussian_kernel_1d(sigma):
+    # 1D gaussian window for separable filtering. Cached per sigma, so that
+    # repeated calls on batches of same-resolution pages (the typical OCR
+    # workload) do not rebuild the same window every time.
+    radius = int(4.0 * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-(x * x) / np.float32(2 * sigma * sigma))
+    return kernel / kernel.sum()
+
+
+
+
+def fast_gauss_approx(
+    # Approximates a gaussian blur with repeated box filters (central limit
+    # theorem). Each box filter pass costs O(1) per pixel regardless of
+    # sigma, whereas a true gaussian kernel grows with sigma, so for the
+    # large surround sigmas this is much cheaper. 3 passes are visually
+    # indistinguishable from a true gaussian for binarization purposes.
+        image,
+        sigma,
+        passes=3
+        ):
+
+    # box width that matches the gaussian variance over the given passes
+    width = int(np.sqrt(12 * sigma * sigma / passes + 1))
+    if width % 2 == 0:
+        width += 1
+
+    blurred = image
+    for _ in range(passes):
+        blurred = cv2.boxFilter(
+            blurred,
+            ddepth=-1,
+            ksize=(width, width),
+            borderType=cv2.BORDER_REFLECT
+            )
+
+    return blurred
+
+
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _off_cs_kernel(center, surround, invert, out):
+    # Fused elementwise computation of the OFF center-surround response:
+    # a single pass over the pixels instead of one full-image pass per
+    # arithmetic operation, so no intermediate HxW arrays are allocated.
+    RANGE_MAX = 1.0
+    RANGE_MIN = 0.0
+    for i in prange(center.shape[0]):
+        for j in range(center.shape[1]):
+            s = surround[i, j]
+            d = s - center[i, j]
+            if d < RANGE_MIN:
+                d = RANGE_MIN
+            off = ((RANGE_MAX + s) * d) / (s + d + 1e-12)
+            # truncate within limits
+            if off < RANGE_MIN:
+                off = RANGE_MIN
+            elif off > RANGE_MAX:
+                off = RANGE_MAX
+            if invert:
+                off = RANGE_MAX - off  # invert for dark letters
+            out[i, j] = off
+
 
 
 
@@ -24,45 +119,146 @@ def get_off_center_surround(
     # Generates the response of OFF center-surround cells, given the receptive
     # field images of center and surround (modeled as gaussians).
         center,
-        surround, 
+        surround,
         invert=True,
-        min_max_norm = True
+        min_max_norm = True,
+        out=None
         ):
-    
-    RANGE_MAX = 1
-    RANGE_MIN = 0
-
-    # off center-surround cell activations
-    off_cs_cells = surround - center
-    off_cs_cells[off_cs_cells<RANGE_MIN] = RANGE_MIN
-    off_cs_cells = (((RANGE_MAX + surround) * off_cs_cells) / 
-                    (surround + off_cs_cells))
-    
-    # truncate within limits
-    off_cs_cells[off_cs_cells<RANGE_MIN] = RANGE_MIN  
-    off_cs_cells[off_cs_cells>RANGE_MAX] = RANGE_MAX
-    
-    if invert is True:
-        off_cs_cells = RANGE_MAX - off_cs_cells  # invert for dark letters
-    
-    
+
+    if out is None:
+        out = np.empty_like(surround)
+
+    # off center-surround cell activations (fused single-pass kernel)
+    _off_cs_kernel(center, surround, invert, out)
+    off_cs_cells = out
+
+
     if min_max_norm is True:
-        off_cs_cells = ((off_cs_cells - off_cs_cells.min()) / 
-                        (off_cs_cells.max() - off_cs_cells.min()))
-        
-    
+        # in-place min-max normalization (no intermediate arrays)
+        np.subtract(off_cs_cells, off_cs_cells.min(), out=off_cs_cells)
+        np.divide(off_cs_cells, off_cs_cells.max(), out=off_cs_cells)
+
+
     return off_cs_cells
     
     
     
 
 
+def warmup():
+    # Pre-triggers the numba compilation of the fused OFF center-surround
+    # kernel on a tiny dummy image, so that a long-running service (e.g. an
+    # OCR worker binarizing pages from a fixed scanner) does not pay the
+    # one-off compile latency on its first real page. The compiled kernel is
+    # shape-generic and cached on disk (cache=True), so after the first
+    # process on a machine this only loads the cached machine code.
+    dummy = np.zeros((8, 8), dtype=np.float32)
+    _off_cs_kernel(dummy, dummy, True, np.empty_like(dummy))
+
+
+
+
+def _gauss_filter(image, sigma):
+    # Dispatches between the box-filter approximation (large sigmas, i.e.
+    # surrounds, where the exact kernel cost grows with sigma) and the exact
+    # separable gaussian with a cached 1D window (small sigmas, i.e. centers)
+    if sigma <= 0:
+        return image  # no-op, like skimage's gaussian with sigma=0
+
+    if sigma >= 5:
+        return fast_gauss_approx(image, sigma)
+
+    kernel = _gaussian_kernel_1d(sigma)
+    return cv2.sepFilter2D(
+        image,
+        ddepth=-1,
+        kernelX=kernel,
+        kernelY=kernel,
+        borderType=cv2.BORDER_REFLECT
+        )
+
+
+
+
+def _threshold_otsu(image):
+    # Otsu threshold of a float image, computed on a uint8-quantized copy:
+    # np.bincount over uint8 labels is a markedly tighter loop than the
+    # generic np.histogram that skimage's threshold_otsu relies on, and the
+    # exhaustive search over the 256-entry histogram is essentially free.
+    # Returns the threshold in the units of the input image.
+    low = float(image.min())
+    high = float(image.max())
+    if high == low:
+        return low
+
+    # quantize with rounding (truncation plus float32 rounding can leave the
+    # extreme bins empty, which would make the cut search below ill-defined)
+    quantized = np.rint((image - low) * (255.0 / (high - low)))
+    quantized = np.clip(quantized, 0, 255).astype(np.uint8)
+    counts = np.bincount(quantized.ravel(), minlength=256).astype(np.float64)
+
+    # maximize the between-class variance over all possible cuts; cuts with
+    # an empty class are invalid and score zero
+    bins = np.arange(256, dtype=np.float64)
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = np.cumsum(counts * bins) / weight1
+        mean2 = (np.cumsum((counts * bins)[::-1]) / weight2[::-1])[::-1]
+        variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    variance12 = np.nan_to_num(variance12)
+
+    return low + np.argmax(variance12) * ((high - low) / 255.0)
+
+
+
+
+def _get_off_cs_combined_gpu(image, center_surround_sigma, verbose):
+    # GPU (CuPy) version of the per-scale loop of binarize_text: the
+    # gaussians and the fused OFF response kernel run on the device, and only
+    # the combined response image comes back to host memory (plus the
+    # per-scale intermediates when verbose=True).
+    image_gpu = cupy.asarray(image)
+    off_cs_cells = cupy.zeros_like(image_gpu)
+    ls_off_cs_cells = []
+    ls_surrounds = []
+    ls_centers = []
+    dc_gaussians = {}  # reuse blurred images when scales share a sigma
+    for scale in center_surround_sigma:
+
+        for sigma in (scale['sigma_surround'], scale['sigma_center']):
+            if sigma not in dc_gaussians:
+                dc_gaussians[sigma] = cupy_ndimage.gaussian_filter(
+                    image_gpu,
+                    sigma=sigma,
+                    mode='reflect'
+                    )
+        surround = dc_gaussians[scale['sigma_surround']]
+        center = dc_gaussians[scale['sigma_center']]
+
+        # off center-surround cell activations, accumulated over the scales
+        scratch = _off_cs_kernel_gpu(center, surround)
+        off_cs_cells += scratch
+
+        # keep the images for later visualizations
+        if verbose is True:
+            ls_surrounds.append(cupy.asnumpy(surround))
+            ls_centers.append(cupy.asnumpy(center))
+            ls_off_cs_cells.append(cupy.asnumpy(scratch))
+
+    return cupy.asnumpy(off_cs_cells), ls_surrounds, ls_centers, ls_off_cs_cells
+
+
+
+
 def binarize_text(
-        image_array, 
+        image_array,
         center_surround_sigma,
         boldness = 1.0,
         remove_elements_smaller_than=10,  # pixels
-        verbose=False
+        verbose=False,
+        device='cpu',
+        pack=False
         ):
     '''
         ----------------------------------------------------------------------
@@ -118,78 +314,133 @@ def binarize_text(
             pixels will be removed.
         verbose: Boolean
             Whether or not to show visualizations for intermediate stages of 
-            the algorithm and comparisons with other basic binarization 
+            the algorithm and comparisons with other basic binarization
             mathods.
-        
+        device: string ('cpu' or 'gpu')
+            Where to run the gaussian filtering and the OFF center-surround
+            responses. 'gpu' requires the optional cupy package and a CUDA
+            device, and pays off for large scans or batches of pages. The
+            thresholding and denoising stages always run on the cpu.
+        pack: Boolean
+            If True, the binary output is packed to 1 bit per pixel with
+            np.packbits (8x smaller, e.g. for writing PBM files or passing
+            over IPC), giving a uint8 array of shape Hx(ceil(W/8)). Unpack
+            with np.unpackbits(packed, axis=-1, count=W).
+
         OUTPUT
         ------
         binary_off_cs_cells: binary numpy array HxW
-            Numpy array of the binary output image.
-            
+            Numpy array of the binary output image. If pack=True, a packed
+            uint8 numpy array Hx(ceil(W/8)) instead.
+
         '''
 
     
     if len(image_array.shape) == 3:
-        image = rgb2gray(image_array.copy())  # rgb-2-grayscale [0,255]->[0,1]
+        if image_array.dtype == np.uint8:
+            # single-pass fixed-point grayscale conversion, avoiding the
+            # float64 intermediates of skimage's rgb2gray
+            image = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+            image = image.astype(np.float32) * np.float32(1 / 255)
+        else:
+            image = rgb2gray(image_array)  # [0,255]->[0,1]
     else:
-        image = img_as_float(image_array.copy())  # [0,255]->[0,1]
-        
-        
+        if image_array.dtype == np.uint8:
+            # direct scaling for the common uint8 case, skipping skimage's
+            # generic dtype dispatch and its float64 intermediate
+            image = image_array.astype(np.float32) * np.float32(1 / 255)
+        else:
+            image = img_as_float(image_array)  # [0,255]->[0,1]
 
-    
-    # generate lists of images of the centers, the surrounds and the 
-    # off-center-surround responses, the surrounds, based on the input scales
-    ls_off_cs_cells = []
-    ls_surrounds = []
-    ls_centers = []
-    for scale in center_surround_sigma:
-     
-        # modelling center surround receptive fields as gaussians
-        surround = gaussian(
-            image, 
-            sigma=scale['sigma_surround'], 
-            mode='reflect'
-            )
-        center = gaussian(
-            image, 
-            sigma=scale['sigma_center'], 
-            mode='reflect'
-            )
-        
-        # keep the images for later visualizations
-        ls_surrounds.append(surround)
-        ls_centers.append(center)
-
-        # off center-surround cell activations
-        ls_off_cs_cells.append(
-            get_off_center_surround(
-            center=center, 
-            surround=surround, 
-            invert=True,
-            min_max_norm=False
+    # float32 is enough for binarization; compared to the float64 that
+    # skimage returns, it halves the bytes moved by every downstream
+    # filtering, arithmetic and thresholding pass
+    image = image.astype(np.float32, copy=False)
+
+
+
+    if device == 'gpu':
+        if cupy is None:
+            raise ImportError(
+                "device='gpu' requires the optional cupy package"
+                )
+        (off_cs_cells,
+         ls_surrounds,
+         ls_centers,
+         ls_off_cs_cells) = _get_off_cs_combined_gpu(
+            image=image,
+            center_surround_sigma=center_surround_sigma,
+            verbose=verbose
             )
-        )
+    else:
+        # combine the off-center-surround responses of all the input scales
+        # by accumulating into a single preallocated buffer (one C-level add
+        # per scale, no per-scale list to stack and reduce afterwards); the
+        # per-scale intermediate images are only kept around for the
+        # visualizations, i.e. when verbose=True
+        off_cs_cells = np.zeros_like(image)
+        scratch = np.empty_like(image)
+        ls_off_cs_cells = []
+        ls_surrounds = []
+        ls_centers = []
+        dc_gaussians = {}  # reuse blurred images when scales share a sigma
 
-    # combine all the off-center-surround response images
-    off_cs_cells = ls_off_cs_cells[0].copy()
-    for i in range(1, len(ls_off_cs_cells)):
-        off_cs_cells += ls_off_cs_cells[i]
-    
-    # min-max normalization to bring back values to [0,1] and supress noise
-    off_cs_cells = ((off_cs_cells - off_cs_cells.min()) / 
-                    (off_cs_cells.max() - off_cs_cells.min()))
-    
-    # global threshold on the off center surround cell activations
-    binary_off_cs_cells = off_cs_cells > threshold_otsu(off_cs_cells) * boldness
+        # modelling center surround receptive fields as gaussians. The two
+        # blurs of a scale are independent, read-only on the input and cv2
+        # releases the GIL while filtering, so they run on separate cores
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for scale in center_surround_sigma:
+
+                dc_futures = {
+                    sigma: executor.submit(_gauss_filter, image, sigma)
+                    for sigma in (scale['sigma_surround'],
+                                  scale['sigma_center'])
+                    if sigma not in dc_gaussians
+                    }
+                for sigma, future in dc_futures.items():
+                    dc_gaussians[sigma] = future.result()
+                surround = dc_gaussians[scale['sigma_surround']]
+                center = dc_gaussians[scale['sigma_center']]
+
+                # off center-surround activations, accumulated over scales
+                get_off_center_surround(
+                    center=center,
+                    surround=surround,
+                    invert=True,
+                    min_max_norm=False,
+                    out=scratch
+                    )
+                np.add(off_cs_cells, scratch, out=off_cs_cells)
+
+                # keep the images for later visualizations
+                if verbose is True:
+                    ls_surrounds.append(surround)
+                    ls_centers.append(center)
+                    ls_off_cs_cells.append(scratch.copy())
+
+
+    # global threshold on the off center surround cell activations; the
+    # threshold is estimated on a 4x4-subsampled view, since Otsu only needs
+    # the shape of the distribution, which is stable under decimation. Otsu
+    # follows affine rescalings of its input, so the min-max normalization
+    # that used to happen here made no difference to the comparison and is
+    # only applied (for display) in the verbose branch below
+    binary_off_cs_cells = (off_cs_cells >
+                           _threshold_otsu(off_cs_cells[::4, ::4]) * boldness)
     
     # morphological filtering: removing elements with small number of pixels
     if remove_elements_smaller_than is not None:
-        binary_off_cs_cells_denoise = ~remove_small_objects(
-            ar=~binary_off_cs_cells,  # black<->white
-            min_size=remove_elements_smaller_than, 
-            connectivity=1, 
-            in_place=False
+        # label the connected components of the inverted image (so that the
+        # dark elements become foreground) and keep only the ones that are
+        # large enough, through a lookup table on the label image
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(
+            (~binary_off_cs_cells).view(np.uint8),  # black<->white
+            connectivity=4
             )
+        keep = stats[:, cv2.CC_STAT_AREA] >= remove_elements_smaller_than
+        keep[0] = False  # background is never a text element
+        # inverting the tiny lookup table instead of the full label image
+        binary_off_cs_cells_denoise = (~keep)[labels]
     else:
         binary_off_cs_cells_denoise = binary_off_cs_cells
     
@@ -197,8 +448,20 @@ def binarize_text(
     
     if verbose is True:
 
+        # matplotlib is only needed for the visualizations, and importing it
+        # costs a few hundred ms plus backend state, so batch pipelines
+        # running with verbose=False should not pay for it (python caches
+        # the module, so repeated verbose calls import it only once)
+        import matplotlib.pyplot as plt
+        plt.close('all')
+
+        # min-max normalization to [0,1], only needed so that the combined
+        # response displays on the same scale as the other images
+        np.subtract(off_cs_cells, off_cs_cells.min(), out=off_cs_cells)
+        np.divide(off_cs_cells, off_cs_cells.max(), out=off_cs_cells)
+
         total_scales = len(ls_off_cs_cells)
-        
+
         # visualize receptive fields and off responses
         plt.figure(figsize=(12,7))
         for i in range(total_scales):
@@ -323,6 +586,10 @@ def binarize_text(
         plt.show()
         
 
+    if pack is True:
+        # 1 bit per pixel instead of numpy's 1 byte per bool
+        return np.packbits(binary_off_cs_cells_denoise, axis=-1)
+
     return binary_off_cs_cells_denoise
 
 